@@ -1,9 +1,13 @@
 import wx
 import serial
+import select
+import re
 import threading
+import queue
 import time
+from collections import deque
 from datetime import datetime
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
 import numpy as np
 
@@ -16,6 +20,8 @@ class DCONController:
         self.stop_bits = 1
         self.parity = 'N'
         self.timeout = 0.2
+        self.rx_buffer_size = 8192
+        self.tx_buffer_size = 4096
         self.ser = None
         self.lock = threading.Lock()
 
@@ -30,21 +36,27 @@ class DCONController:
         self.plusPUMP = 6
         self.minusPUMP = 7
         self.pressureChanel = 5
+        self.channel_re = re.compile(r'[+-]?\d+\.\d+')
+        self.do_prefix = f"{7050:04X}{self.adrDO:02X}".encode()
 
         # Параметры
         self.minMA = 3.86
         self.maxMA = 19.368
         self.minP = 0
         self.maxP = 6
+        self.ma_scale = (self.maxP - self.minP) / (self.maxMA - self.minMA)
+        self.ema_alpha = 0.25
 
         # Переменные состояния
         self.pressurePOSLE = 0.0
+        self.pressure_ema = None
+        self.last_channels = np.zeros(0, dtype=np.float32)
+        self.last_pressures = np.zeros(0, dtype=np.float32)
         self.stop_igra = False
         self.plus_counter = 0
         self.minus_counter = 0
         self.fixed_open = 0.0
         self.fixed_close = 0.0
-        self.plus_dim_press = [0.0] * 41
 
         # Тайминги
         self.plus_minus_time = 100
@@ -53,6 +65,14 @@ class DCONController:
         self.plus_step = 80
         self.minus_step = 40
 
+        # Готовые команды окончания импульса частоты
+        self.plus_off_cmd = self.do_command(self.plusPUMP, 0)
+        self.minus_off_cmd = self.do_command(self.minusPUMP, 0)
+
+        # Буферы графика
+        self.plus_dim_press = np.zeros(self.plus_step, dtype=np.float32)
+        self.plus_x_axis = np.arange(self.plus_step)
+
     def connect(self):
         """Подключение к COM-порту"""
         try:
@@ -62,8 +82,14 @@ class DCONController:
                 bytesize=self.data_bits,
                 stopbits=self.stop_bits,
                 parity=self.parity,
-                timeout=self.timeout
+                timeout=0
             )
+            # Буферы драйвера задаются только на Windows. Задержку USB-COM
+            # адаптера (Latency Timer, по умолчанию 16 мс) следует снизить до 1 мс:
+            # Windows - свойства порта в диспетчере устройств,
+            # Linux - /sys/bus/usb-serial/devices/ttyUSBx/latency_timer
+            if hasattr(self.ser, 'set_buffer_size'):
+                self.ser.set_buffer_size(rx_size=self.rx_buffer_size, tx_size=self.tx_buffer_size)
             return True
         except Exception as e:
             print(f"Ошибка подключения: {e}")
@@ -71,75 +97,153 @@ class DCONController:
 
     def disconnect(self):
         """Отключение от COM-порта"""
-        if self.ser and self.ser.is_open:
-            self.ser.close()
-
-    def send_command(self, command):
-        """Отправка команды устройству"""
         with self.lock:
-            try:
-                if not self.ser or not self.ser.is_open:
-                    if not self.connect():
-                        return False
+            if self.ser and self.ser.is_open:
+                self.ser.close()
 
-                self.ser.write(command.encode())
-                time.sleep(0.1)
-                return True
-            except Exception as e:
-                print(f"Ошибка отправки команды: {e}")
+    def _transfer_locked(self, data):
+        """Запись команды и чтение ответа на неё под блокировкой"""
+        with self.lock:
+            if not self.ser or not self.ser.is_open:
+                if not self.connect():
+                    return None
+            return self._transfer(data)
+
+    def _transfer(self, data):
+        """Запись команды и чтение ответа (блокировка уже захвачена)"""
+        self.ser.write(data)
+        return self._read_response()
+
+    @staticmethod
+    def _check_reply(data, reply):
+        """Проверка наличия ответа модуля на команду"""
+        if not reply:
+            print(f"Нет ответа на команду: {data!r}")
+            return False
+        return True
+
+    def _read_response(self):
+        """Чтение ответа до символа CR пачками из буфера приёма"""
+        buf = bytearray()
+        deadline = time.monotonic() + self.timeout
+        # На Windows дескриптор порта недоступен для select
+        fd = getattr(self.ser, 'fd', None)
+        while True:
+            n = self.ser.in_waiting
+            if n:
+                buf += self.ser.read(n)
+                if b'\r' in buf:
+                    break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if fd is not None:
+                select.select([fd], [], [], min(remaining, 0.05))
+            else:
+                time.sleep(0.001)
+        return bytes(buf)
+
+    def send_command_bytes(self, data):
+        """Отправка готовой команды в байтах"""
+        try:
+            reply = self._transfer_locked(data)
+            if reply is None:
                 return False
+            return self._check_reply(data, reply)
+        except Exception as e:
+            print(f"Ошибка отправки команды: {e}")
+            return False
+
+    def send_command(self, command):
+        """Отправка команды устройству"""
+        return self.send_command_bytes(command.encode())
 
     def send_705X_XX(self, module_id, address, channel, value):
         """Отправка команды модулю 705X"""
         cmd = f"{module_id:04X}{address:02X}{channel:02X}{value:02X}\r"
         return self.send_command(cmd)
 
-    def read_7019_2(self):
-        """Чтение данных с модуля 7019"""
-        with self.lock:
-            try:
+    def do_command(self, channel, value):
+        """Команда на канал модуля дискретных выходов 7050 в байтах"""
+        return self.do_prefix + b"%02X%02X\r" % (channel, value)
+
+    def send_do(self, channel, value):
+        """Отправка команды на канал модуля дискретных выходов 7050"""
+        return self.send_command_bytes(self.do_command(channel, value))
+
+    def send_many(self, commands):
+        """Отправка нескольких команд за одну блокировку порта"""
+        # Шина RS-485 полудуплексная: каждая команда ждёт свой ответ перед следующей
+        try:
+            with self.lock:
                 if not self.ser or not self.ser.is_open:
                     if not self.connect():
-                        return None
-
-                # Команда чтения
-                cmd = f"7017{self.adrAO:02X}00\r"
-                self.ser.write(cmd.encode())
-                time.sleep(0.1)
-
-                # Чтение ответа
-                response = self.ser.readline().decode().strip()
-                if response:
-                    # Парсинг ответа (упрощенно)
-                    values = response.split()
-                    if len(values) > self.pressureChanel:
-                        pressure_raw = float(values[self.pressureChanel])
-                        # Нормирование значения
-                        pressure_norm = abs(pressure_raw - self.minMA) * (self.maxP - self.minP) / (
-                                    self.maxMA - self.minMA)
-                        self.pressurePOSLE = round(pressure_norm, 2)
-                        return self.pressurePOSLE
+                        return False
+                ok = True
+                for data in commands:
+                    if not self._check_reply(data, self._transfer(data)):
+                        ok = False
+                return ok
+        except Exception as e:
+            print(f"Ошибка отправки команды: {e}")
+            return False
 
+    def read_7019_2(self):
+        """Чтение данных с модуля 7019"""
+        try:
+            # Блокировка удерживается только на время обмена байтами
+            raw = self._transfer_locked(f"7017{self.adrAO:02X}00\r".encode())
+            if raw is None:
                 return None
-            except Exception as e:
-                print(f"Ошибка чтения: {e}")
-                return None
+
+            response = raw.decode().strip()
+            if response:
+                # Парсинг всех каналов ответа
+                channels = np.array(self.channel_re.findall(response), dtype=np.float32)
+                if len(channels) > self.pressureChanel:
+                    self.last_channels = channels
+                    # Нормирование значений всех каналов
+                    self.last_pressures = np.abs(channels - self.minMA) * self.ma_scale
+                    pressure_norm = float(self.last_pressures[self.pressureChanel])
+                    # Экспоненциальное сглаживание (общее для потоков опроса и испытаний)
+                    with self.lock:
+                        if self.pressure_ema is None:
+                            self.pressure_ema = pressure_norm
+                        else:
+                            self.pressure_ema = (self.ema_alpha * pressure_norm
+                                                 + (1 - self.ema_alpha) * self.pressure_ema)
+                        self.pressurePOSLE = round(self.pressure_ema, 2)
+                        return self.pressurePOSLE
+
+            return None
+        except Exception as e:
+            print(f"Ошибка чтения: {e}")
+            return None
 
 
 class MainFrame(wx.Frame):
     def __init__(self):
         super().__init__(None, title="Система управления насосами и клапанами", size=(1000, 700))
         self.controller = DCONController()
-        self.timer = wx.Timer(self)
         self.test_timer = None
         self.is_test_running = False
+        self.poll_stop = threading.Event()
+
+        # Состояние исполнительных устройств
+        self.pump_on = False
+        c = self.controller
+        self.valve_state = {valve: False for valve in (c.valve1, c.valve2, c.valve3, c.valve4)}
+
+        # Буфер обновлений GUI из потока испытаний
+        self.pending_log = deque()
+        self.plot_q = queue.Queue(maxsize=1)
 
         self.init_ui()
-        self.Bind(wx.EVT_TIMER, self.on_timer, self.timer)
         self.Bind(wx.EVT_CLOSE, self.on_close)
 
-        # Запуск таймера для обновления давления
-        self.timer.Start(1000)
+        # Запуск фонового опроса давления
+        self.poll_thread = threading.Thread(target=self._pressure_loop, daemon=True)
+        self.poll_thread.start()
 
     def init_ui(self):
         """Инициализация интерфейса"""
@@ -211,13 +315,17 @@ class MainFrame(wx.Frame):
         self.text_memo = wx.TextCtrl(panel, style=wx.TE_MULTILINE | wx.TE_READONLY)
 
         # График
-        self.fig, self.ax = plt.subplots(figsize=(8, 4))
+        self.fig = Figure(figsize=(8, 4))
+        self.ax = self.fig.add_subplot(111)
         self.canvas = FigureCanvas(panel, -1, self.fig)
         self.ax.set_title('График давления')
         self.ax.set_xlabel('Шаги')
         self.ax.set_ylabel('Давление (атм)')
-        self.line, = self.ax.plot([], [])
+        self.line, = self.ax.plot([], [], animated=True)
+        self.ax.set_xlim(0, self.controller.plus_step)
         self.ax.set_ylim(0, 6)
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
 
         # Компоновка элементов
         main_sizer.Add(pressure_sizer, 0, wx.EXPAND | wx.ALL, 5)
@@ -236,16 +344,64 @@ class MainFrame(wx.Frame):
         else:
             self.log_message("Ошибка подключения к COM-порту")
 
+    @staticmethod
+    def format_log(message):
+        """Форматирование строки лога с отметкой времени"""
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        return f"[{timestamp}] {message}\n"
+
     def log_message(self, message):
         """Добавление сообщения в лог"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        self.text_memo.AppendText(f"[{timestamp}] {message}\n")
+        self.text_memo.AppendText(self.format_log(message))
 
-    def on_timer(self, event):
-        """Обновление давления по таймеру"""
-        pressure = self.controller.read_7019_2()
-        if pressure is not None:
-            self.txt_pressure.SetValue(f"{pressure:.2f}")
+    def queue_log(self, message):
+        """Постановка сообщения в очередь лога (из любого потока)"""
+        self.pending_log.append(self.format_log(message))
+
+    def post_plot(self, step, pressure):
+        """Передача точки графика с заменой ещё не отрисованной"""
+        try:
+            self.plot_q.put_nowait((step, pressure))
+        except queue.Full:
+            try:
+                self.plot_q.get_nowait()
+            except queue.Empty:
+                pass
+            self.plot_q.put_nowait((step, pressure))
+
+    def flush_ui(self):
+        """Пакетный вывод накопленного лога и обновление графика"""
+        lines = []
+        while self.pending_log:
+            lines.append(self.pending_log.popleft())
+        if lines:
+            self.text_memo.AppendText("".join(lines))
+
+        try:
+            step, pressure = self.plot_q.get_nowait()
+        except queue.Empty:
+            return
+        self.update_graph(step, pressure)
+
+    def on_flush_timer(self):
+        """Периодический вывод обновлений во время испытаний"""
+        self.flush_ui()
+        if self.is_test_running:
+            wx.CallLater(50, self.on_flush_timer)
+
+    def _pressure_loop(self):
+        """Фоновый опрос давления раз в секунду"""
+        while not self.poll_stop.is_set():
+            pressure = self.controller.read_7019_2()
+            if pressure is not None:
+                wx.CallAfter(self.show_pressure, f"{pressure:.2f}")
+            self.poll_stop.wait(1.0)
+
+    def show_pressure(self, text):
+        """Вывод давления из потока опроса (в потоке GUI)"""
+        # Флаг проверяется в потоке GUI, поэтому после on_close вывод не выполняется
+        if not self.poll_stop.is_set():
+            self.txt_pressure.SetValue(text)
 
     def on_read_pressure(self, event):
         """Ручное обновление давления"""
@@ -256,39 +412,43 @@ class MainFrame(wx.Frame):
 
     def on_pump_toggle(self, event):
         """Включение/выключение насоса"""
-        if self.btn_pump.GetBackgroundColour() == wx.Colour(0, 255, 0):  # Зеленый
-            self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.startPUMP, 1)
+        if not self.pump_on:
+            self.pump_on = True
+            self.controller.send_do(self.controller.startPUMP, 1)
             self.btn_pump.SetBackgroundColour(wx.Colour(255, 0, 0))  # Красный
             self.btn_pump.SetLabel("Стоп насоса")
             self.log_message("Насос запущен")
         else:
-            self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.startPUMP, 0)
+            self.pump_on = False
+            self.controller.send_do(self.controller.startPUMP, 0)
             self.btn_pump.SetBackgroundColour(wx.Colour(0, 255, 0))  # Зеленый
             self.btn_pump.SetLabel("Пуск насоса")
             self.log_message("Насос остановлен")
 
     def on_plus_frequency(self, event):
         """Увеличение частоты"""
-        self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.plusPUMP, 1)
-        wx.CallLater(self.controller.plus_minus_time, lambda:
-        self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.plusPUMP, 0))
+        self.controller.send_do(self.controller.plusPUMP, 1)
+        threading.Timer(self.controller.plus_minus_time / 1000, self.controller.send_command_bytes,
+                        args=(self.controller.plus_off_cmd,)).start()
         self.log_message("Увеличена частота насоса")
 
     def on_minus_frequency(self, event):
         """Уменьшение частоты"""
-        self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.minusPUMP, 1)
-        wx.CallLater(self.controller.plus_minus_time, lambda:
-        self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.minusPUMP, 0))
+        self.controller.send_do(self.controller.minusPUMP, 1)
+        threading.Timer(self.controller.plus_minus_time / 1000, self.controller.send_command_bytes,
+                        args=(self.controller.minus_off_cmd,)).start()
         self.log_message("Уменьшена частота насоса")
 
     def toggle_valve(self, btn, valve_num, valve_name):
         """Переключение состояния клапана"""
-        if btn.GetBackgroundColour() == wx.Colour(255, 0, 0):  # Красный
-            self.controller.send_705X_XX(7050, self.controller.adrDO, valve_num, 1)
+        if not self.valve_state[valve_num]:
+            self.valve_state[valve_num] = True
+            self.controller.send_do(valve_num, 1)
             btn.SetBackgroundColour(wx.Colour(0, 255, 0))  # Зеленый
             self.log_message(f"{valve_name} открыт")
         else:
-            self.controller.send_705X_XX(7050, self.controller.adrDO, valve_num, 0)
+            self.valve_state[valve_num] = False
+            self.controller.send_do(valve_num, 0)
             btn.SetBackgroundColour(wx.Colour(255, 0, 0))  # Красный
             self.log_message(f"{valve_name} закрыт")
 
@@ -316,25 +476,27 @@ class MainFrame(wx.Frame):
         self.controller.stop_igra = False
         self.controller.plus_counter = 0
         self.controller.minus_counter = 0
+        self.controller.pressure_ema = None
+        # Поток испытаний выключает насос и клапаны перед включением
+        self.reset_buttons()
 
-        # Очистка графика
+        # Очистка графика (пропущенные шаги остаются разрывами)
+        self.controller.plus_dim_press[:] = np.nan
         self.line.set_data([], [])
-        self.ax.set_xlim(0, self.controller.plus_step)
         self.canvas.draw()
+        self.plot_q = queue.Queue(maxsize=1)
 
         # Запуск теста в отдельном потоке
         threading.Thread(target=self.run_forward_test, daemon=True).start()
+        wx.CallLater(50, self.on_flush_timer)
 
     def run_forward_test(self):
         """Выполнение прямых испытаний"""
         try:
             # Настройка системы
-            self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.minusPUMP, 0)
-            self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.valve1, 0)
-            self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.valve2, 0)
-            self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.valve3, 0)
-            self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.valve4, 0)
-            self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.startPUMP, 0)
+            c = self.controller
+            c.send_many([c.do_command(ch, 0) for ch in
+                         (c.minusPUMP, c.valve1, c.valve2, c.valve3, c.valve4, c.startPUMP)])
 
             # Включение насоса и клапанов
             wx.CallAfter(self.on_pump_toggle, None)
@@ -343,6 +505,13 @@ class MainFrame(wx.Frame):
 
             time.sleep(1)
 
+            # Максимум давления считается по ходу испытаний
+            max_pressure = float('-inf')
+
+            # Шаги отсчитываются от абсолютных моментов времени без накопления задержек
+            period = self.controller.plus_step_time / 1000
+            next_t = time.monotonic()
+
             # Цикл испытаний
             for step in range(self.controller.plus_step):
                 if self.controller.stop_igra:
@@ -352,41 +521,51 @@ class MainFrame(wx.Frame):
                 pressure = self.controller.read_7019_2()
                 if pressure is not None:
                     self.controller.plus_dim_press[step] = pressure
+                    self.controller.plus_counter += 1
+                    if pressure > max_pressure:
+                        max_pressure = pressure
 
-                    # Обновление GUI
-                    wx.CallAfter(self.update_graph, step, pressure)
-                    wx.CallAfter(self.log_message, f"Шаг {step}. Давление: {pressure:.2f} атм")
+                    # Обновление GUI (выводится пакетами в flush_ui)
+                    self.post_plot(step, pressure)
+                    self.queue_log(f"Шаг {step}. Давление: {pressure:.2f} атм")
 
                 # Увеличение частоты
-                self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.plusPUMP, 1)
+                self.controller.send_do(self.controller.plusPUMP, 1)
                 time.sleep(self.controller.plus_minus_time / 1000)
-                self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.plusPUMP, 0)
+                self.controller.send_do(self.controller.plusPUMP, 0)
 
-                time.sleep(self.controller.plus_step_time / 1000)
+                next_t += period
+                delay = next_t - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
 
             # Анализ результатов
-            max_pressure = max(self.controller.plus_dim_press[:self.controller.plus_counter])
-            self.controller.fixed_open = max_pressure
+            self.controller.fixed_open = max_pressure if self.controller.plus_counter else 0.0
 
-            wx.CallAfter(self.log_message,
-                         f"Зафиксировано давление открытия: {max_pressure:.2f} атм\n"
-                         f"Зафиксировано давление закрытия: {self.controller.fixed_close:.2f} атм")
+            self.queue_log(f"Зафиксировано давление открытия: {self.controller.fixed_open:.2f} атм\n"
+                           f"Зафиксировано давление закрытия: {self.controller.fixed_close:.2f} атм")
 
         except Exception as e:
-            wx.CallAfter(self.log_message, f"Ошибка при испытаниях: {e}")
+            self.queue_log(f"Ошибка при испытаниях: {e}")
         finally:
             self.is_test_running = False
             wx.CallAfter(self.on_stop, None)
 
     def update_graph(self, step, pressure):
         """Обновление графика"""
-        x_data = list(range(step + 1))
-        y_data = self.controller.plus_dim_press[:step + 1]
+        self.line.set_data(self.controller.plus_x_axis[:step + 1],
+                           self.controller.plus_dim_press[:step + 1])
+        if self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.line)
+        self.canvas.blit(self.ax.bbox)
 
-        self.line.set_data(x_data, y_data)
-        self.ax.relim()
-        self.ax.autoscale_view()
-        self.canvas.draw()
+    def on_draw(self, event):
+        """Сохранение фона графика после полной перерисовки"""
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.line)
 
     def on_revers_test(self, event):
         """Обратные испытания"""
@@ -396,19 +575,25 @@ class MainFrame(wx.Frame):
     def on_stop(self, event):
         """Остановка всех процессов"""
         self.controller.stop_igra = True
-        self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.valve1, 0)
-        self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.valve2, 0)
-        self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.valve3, 0)
-        self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.valve4, 0)
-        self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.startPUMP, 0)
-        self.controller.send_705X_XX(7050, self.controller.adrDO, self.controller.minusPUMP, 1)
+        c = self.controller
+        c.send_many([c.do_command(c.valve1, 0),
+                     c.do_command(c.valve2, 0),
+                     c.do_command(c.valve3, 0),
+                     c.do_command(c.valve4, 0),
+                     c.do_command(c.startPUMP, 0),
+                     c.do_command(c.minusPUMP, 1)])
 
         # Сброс цветов кнопок
         wx.CallAfter(self.reset_buttons)
+        self.flush_ui()
         self.log_message("Все процессы остановлены")
 
     def reset_buttons(self):
         """Сброс состояний кнопок"""
+        self.pump_on = False
+        for valve_num in self.valve_state:
+            self.valve_state[valve_num] = False
+
         self.btn_pump.SetBackgroundColour(wx.Colour(0, 255, 0))
         self.btn_pump.SetLabel("Пуск насоса")
 
@@ -417,7 +602,8 @@ class MainFrame(wx.Frame):
 
     def on_close(self, event):
         """Обработка закрытия приложения"""
-        self.timer.Stop()
+        self.poll_stop.set()
+        self.poll_thread.join(timeout=2 * self.controller.timeout + 1)
         self.controller.disconnect()
         self.Destroy()
 